@@ -8,6 +8,9 @@ from chat.handlers.assemblyai.audio_transcription import transcribe_audio, suppo
 from chat.handlers.openai.completions import language_detection
 from chat.handlers.openai import text_to_image as dalle_text_to_image
 
+# matches [img: "prompt"] with any number of spaces between the colon and the quote
+IMG_GENERATION_PATTERN = re.compile(r"\[img:\s*\"(.*)\"\]", flags=re.IGNORECASE)
+
 def verify_image_generation(msg: str) -> Tuple[str, bool]:
     """
     Checks if the reply contains an image generation prompt. 
@@ -17,19 +20,15 @@ def verify_image_generation(msg: str) -> Tuple[str, bool]:
     if "[img:" not in msg.lower():
         return msg, False
     # get the prompt and real reply from the message '{reply}[image generation: "{prompt}"]'
-    img_generation_prompt = re.search(
-        # regex to match [img: "prompt"] with any number of spaces between the colon and the quote
-        r"\[img:\s*\"(.*)\"\]", msg, flags=re.IGNORECASE
-
-    )
+    img_generation_prompt = IMG_GENERATION_PATTERN.search(msg)
     if img_generation_prompt is None:
         logging.info(f"No matched image generation prompt found for message: {msg}")
-        new_msg = re.sub(r"\[img:\s*\"(.*)\"\]", "", msg, flags=re.IGNORECASE)
+        new_msg = IMG_GENERATION_PATTERN.sub("", msg)
         if new_msg:
             return new_msg, False
         return msg, False
     img_generation_prompt = img_generation_prompt.group(1)
-    new_msg = re.sub(r"\[img:\s*\"(.*)\"\]", "", msg, flags=re.IGNORECASE)
+    new_msg = IMG_GENERATION_PATTERN.sub("", msg)
     logging.info(f"Image generation prompt: '{img_generation_prompt}'")
     return new_msg, img_generation_prompt
 
@@ -76,7 +75,7 @@ async def check_and_send_image_generation(prompt: str, chat:OpenAIChatManager, c
         return False
     # generate the image and send it to the user
     chat.logger.info(f"Generating image for prompt: {prompt}")
-    img_url = await dalle_text_to_image(prompt, as_url=True)
+    img_url = await dalle_text_to_image(prompt, as_url=True, size=chat.image_size)
     img_body = prompt if chat.caption_images else None
     await client.send_message_async(img_body, chat.sender.phone_number, media_url=img_url, media_type='image')
     chat.num_images_generated += 1
@@ -1,13 +1,20 @@
-import os, logging
+import os, logging, string
 from datetime import datetime
 from dotenv import find_dotenv, load_dotenv
+
+# Load environment variables once, before the handlers read their configuration
+load_dotenv(find_dotenv())
+
 from flask import Flask, request, jsonify
 from chat.clients.twilio import TwilioWhatsAppClient, TwilioWhatsAppMessage
 from chat.handlers.openai import (
-    chat_completion as chatgpt_completion,
+    achat_completion as chatgpt_completion,
     # text_completion as chatgpt_completion,
     voice_transcription as whisper_transcription,
+    asummarize_messages,
+    SemanticCache,
 )
+from chat.handlers.http import openai_aiosession
 from app.handlers import (
     check_and_send_image_generation,
     ensure_user_language,
@@ -19,17 +26,31 @@ from app.whatsapp.chat import Sender, OpenAIChatManager
 
 # from chat.handlers.image import image_captioning
 
-# Load environment variables and configurations for the app
-load_dotenv(find_dotenv())
+# configurations for the app
 logging.basicConfig()
 logger = logging.getLogger("WP-APP")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.environ.get("LOG_LEVEL", "DEBUG").upper())
 
 # chat agent configuration
 start_template = os.environ.get("CHAT_START_TEMPLATE")
 if os.path.exists(start_template):
     with open(start_template, "r") as f:
         start_template = f.read()
+# per-user details are sent in a separate system message after the start template
+# so that the start of every conversation is the same and can be cached by the API
+user_template = os.environ.get(
+    "CHAT_USER_TEMPLATE", "You are talking with {user}. Today's date is {today}."
+)
+# templates written for older versions may still have per-user fields in them
+start_template_fields = {
+    name for _, name, _, _ in string.Formatter().parse(start_template) if name
+}
+if start_template_fields:
+    logger.warning(
+        "The start template has the fields %s, which are filled in for every user. "
+        "Move them to CHAT_USER_TEMPLATE so the start of the conversations can be cached.",
+        sorted(start_template_fields),
+    )
 
 chat_options = dict(
     model=os.environ.get("CHAT_MODEL", "gpt-3.5-turbo"),
@@ -38,6 +59,8 @@ chat_options = dict(
     goodbye_message="Goodbye! I'll be here if you need me.",
     voice_transcription=True,
     allow_images=True,
+    image_size=os.environ.get("IMAGE_SIZE", "512x512"),
+    max_context_tokens=int(os.environ.get("MAX_CONTEXT_TOKENS", 3000)),
 )
 model_options = dict(
     model=os.environ.get("CHAT_MODEL", "gpt-3.5-turbo"),
@@ -48,6 +71,11 @@ model_options = dict(
     presence_penalty=os.environ.get("PRESENCE_PENALTY", 0.1),
     n=1,
 )
+if os.environ.get("SEMANTIC_CACHE_THRESHOLD"):
+    # reuse replies to messages similar to previous ones with the same context
+    model_options["semantic_cache"] = SemanticCache(
+        threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD"))
+    )
 
 # create the chat client
 chat_client = TwilioWhatsAppClient(
@@ -62,6 +90,12 @@ app = Flask(__name__)
 
 @app.route("/whatsapp/reply", methods=["POST"])
 async def reply_to_whatsapp_message():
+    # the OpenAI requests of the message (reply, summary, image) share one session
+    async with openai_aiosession():
+        return await reply_to_message()
+
+
+async def reply_to_message():
     logger.info(f"Obtained request: {dict(request.values)}")
     # create the chat manager
     sender = Sender(
@@ -69,10 +103,17 @@ async def reply_to_whatsapp_message():
         name=request.values.get("ProfileName", request.values.get("From")),
     )
     chat = OpenAIChatManager.get_or_create(sender, logger=logger, **chat_options)
-    chat.start_system_message = chat_options.get("start_system_message").format(
-        user=sender.name, today=datetime.now().strftime("%Y-%m-%d")
-    )
-    chat.messages[0] = chat.make_message(chat.start_system_message, role="system")
+    user_fields = dict(user=sender.name, today=datetime.now().strftime("%Y-%m-%d"))
+    start_message = chat.start_system_message
+    if start_template_fields:
+        start_message = start_message.format(**user_fields)
+    chat.messages[0] = chat.make_message(start_message, role="system")
+    # refreshed on every message so that the date doesn't go stale
+    user_message = user_template.format(**user_fields)
+    if len(chat.messages) == 1:
+        chat.add_message(user_message, role="system")
+    else:
+        chat.messages[1] = chat.make_message(user_message, role="system")
     # parse and process the message
     new_message = chat_client.parse_request_values(request.values)
     msg = verify_and_process_media(new_message, chat)
@@ -80,12 +121,26 @@ async def reply_to_whatsapp_message():
     if message_empty_or_goodbye(msg, chat):
         return jsonify({"status": "ok"})
     # if this is the first message, ensure the language is set
-    logger.info("Chat has %d messages", len(chat.messages))
-    if len(chat.messages) == 1:
+    logger.info("Chat has %d messages (%d tokens)", len(chat.messages), chat.token_count)
+    if chat.num_user_messages == 0:
         await ensure_user_language(chat, text=msg)
     # generate the reply
     chat.add_message(msg, role="user")
-    reply = chatgpt_completion(chat.messages, **model_options).strip()
+    # summarize the oldest messages so that the prompt size doesn't keep growing
+    old_messages = chat.overflowing_messages()
+    if old_messages:
+        logger.info("Summarizing the %d oldest messages of the chat", len(old_messages))
+        summary = await asummarize_messages(
+            old_messages, model=chat.model, max_tokens=chat.summary_max_tokens
+        )
+        chat.summarize_history(summary, len(old_messages))
+    # the per-message token counts of the chat are memoized, so the rate limiter
+    # gets the exact prompt size without tokenizing the conversation again
+    reply = (
+        await chatgpt_completion(
+            chat.messages, num_prompt_tokens=chat.token_count, **model_options
+        )
+    ).strip()
     logger.info(f"Generated reply of length {len(reply)}")
     # check if the reply is requesting an image generation
     reply, img_prompt = verify_image_generation(reply)
@@ -103,9 +158,11 @@ async def reply_to_whatsapp_message():
         await check_and_send_image_generation(img_prompt, chat, client=chat_client)
     # save the chat
     chat.save()
-    logger.info(
-        f"--------------\nConversation:\n{chat.get_conversation()}\n----------------"
-    )
+    # the full transcript grows with every turn, only build it when it is logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            f"--------------\nConversation:\n{chat.get_conversation()}\n----------------"
+        )
     return jsonify({"status": "ok"})
 
 def message_empty_or_goodbye(msg, chat):
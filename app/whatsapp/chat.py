@@ -1,11 +1,31 @@
 from dataclasses import dataclass, field
 from datetime import datetime
+from pathlib import Path
+import json
 import logging
-from typing import Union, Callable
+import os
+import re
+import tempfile
+from typing import Optional, Union, Callable
+
+from chat.handlers.openai.tokens import num_tokens, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
 # from apscheduler.schedulers.background import BackgroundScheduler
 
 managers = {}
 
+# prefix of the system message that replaces the summarized part of the conversation
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+# attributes of a chat that are stored on disk when CHAT_STATE_DIR is set
+# (message_info isn't: it is never trimmed, so it would grow the file on every message)
+PERSISTED_FIELDS = (
+    "messages",
+    "num_user_messages",
+    "num_images_generated",
+    "language",
+    "transcription_language",
+)
+
 
 @dataclass
 class OpenAIChatManager:
@@ -15,6 +35,7 @@ class OpenAIChatManager:
     start_system_message: Union[str, Callable] = None
     messages: list = field(default_factory=list)
     message_info: list = field(default_factory=list)
+    num_user_messages: int = 0
     num_images_generated: int = 0
     max_image_generations: int = float("inf")
     allow_images: bool = True
@@ -23,11 +44,16 @@ class OpenAIChatManager:
     language: str = "english"
     # scheduler: BackgroundScheduler = None
     conversation_expire_seconds: int = 60 * 60 * 3  # 3 hours
+    max_context_tokens: int = 3000
+    min_recent_messages: int = 4  # messages that are never summarized
     caption_images: bool = True
+    image_size: str = "512x512"
     goodbye_message: str = "Goodbye {user}! I'll be here if you need me."
     logger: logging.Logger = None
+    # token counts of the contents of the messages, so each one is only tokenized once
+    _token_counts: dict = field(default_factory=dict, init=False, repr=False)
     
-    end_conversation_phrases = [
+    end_conversation_phrases = frozenset([
         "bye",
         "goodbye",
         "see you later",
@@ -40,7 +66,7 @@ class OpenAIChatManager:
         "exit",
         "restart conversation",
         "[restart]",
-    ]
+    ])
 
     def __post_init__(self):
         self.add_message(self.start_system_message, role="system")
@@ -50,13 +76,46 @@ class OpenAIChatManager:
     @classmethod
     def get_or_create(cls, sender: "Sender", model: str = "gpt-3.5-turbo", **kwargs):
         if sender.phone_number not in managers:
-            managers[sender.phone_number] = cls(sender, model)
+            chat = cls(sender, model)
+            chat.load()
+            managers[sender.phone_number] = chat
         for k, v in kwargs.items():
             setattr(managers[sender.phone_number], k, v)
         return managers[sender.phone_number]
 
     def save(self):
         managers[self.sender.phone_number] = self
+        path = chat_state_path(self.sender.phone_number)
+        if path is None:
+            return
+        state = {name: getattr(self, name) for name in PERSISTED_FIELDS}
+        state["updated_at"] = datetime.now().isoformat()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # unique temporary file: messages of the same sender can be handled concurrently
+        with tempfile.NamedTemporaryFile(
+            "w", dir=path.parent, prefix=path.stem, suffix=".tmp", delete=False
+        ) as f:
+            json.dump(state, f)
+        Path(f.name).replace(path)
+
+    def load(self) -> bool:
+        """
+        Restores the conversation saved on disk for the sender, if any.
+        Returns whether a (not expired) conversation was restored.
+        """
+        path = chat_state_path(self.sender.phone_number)
+        if path is None or not path.exists():
+            return False
+        with open(path, "r") as f:
+            state = json.load(f)
+        updated_at = datetime.fromisoformat(state.pop("updated_at"))
+        if (datetime.now() - updated_at).total_seconds() > self.conversation_expire_seconds:
+            path.unlink()
+            return False
+        for name in PERSISTED_FIELDS:
+            if name in state:
+                setattr(self, name, state[name])
+        return True
 
     def get_messages_from(self, role: str):
         return [msg for msg in self.messages if msg["role"] == role]
@@ -64,9 +123,73 @@ class OpenAIChatManager:
     def add_message(self, message: str, role: str = "user"):
         msg = self.make_message(message, role)
         self.messages.append(msg)
+        if role == "user":
+            self.num_user_messages += 1
         msg_info = {**msg, "timestamp": datetime.now().isoformat()}
         self.message_info.append(msg_info)
 
+    @property
+    def token_count(self) -> int:
+        """Number of prompt tokens of the conversation"""
+        return TOKENS_PER_REPLY + sum(self._message_tokens(msg) for msg in self.messages)
+
+    def _message_tokens(self, msg: dict) -> int:
+        content = msg["content"]
+        if content not in self._token_counts:
+            self._token_counts[content] = num_tokens(content, self.model)
+        return TOKENS_PER_MESSAGE + self._token_counts[content]
+
+    def _forget_token_counts(self):
+        """Drops the token counts of the messages that are no longer in the conversation"""
+        contents = {msg["content"] for msg in self.messages}
+        self._token_counts = {
+            content: count for content, count in self._token_counts.items()
+            if content in contents
+        }
+
+    @property
+    def summary_max_tokens(self) -> int:
+        """Maximum length of the summary that replaces the overflowing messages"""
+        return self.max_context_tokens // 4
+
+    def overflowing_messages(self) -> list:
+        """
+        Returns the oldest messages of the conversation that should be summarized
+        once it exceeds `max_context_tokens`. Enough messages are returned for the
+        conversation to be at most half the budget once the summary (of up to
+        `summary_max_tokens`) is added, so that it isn't summarized again on the
+        next turns. The starting system messages and the last `min_recent_messages`
+        are always kept.
+        """
+        total_tokens = self.token_count
+        if total_tokens <= self.max_context_tokens:
+            return []
+        low_water_mark = self.max_context_tokens // 2 - self.summary_max_tokens
+        start = self._history_start()
+        last = len(self.messages) - self.min_recent_messages
+        end = start
+        while total_tokens > low_water_mark and end < last:
+            total_tokens -= self._message_tokens(self.messages[end])
+            end += 1
+        return self.messages[start:end]
+
+    def summarize_history(self, summary: str, num_messages: int):
+        """Replaces the oldest `num_messages` of the conversation with their summary"""
+        start = self._history_start()
+        # not deleted through __delitem__: the user still sent those messages
+        del self.messages[start:start + num_messages]
+        self.messages.insert(start, self.make_message(SUMMARY_PREFIX + summary, role="system"))
+        self._forget_token_counts()
+
+    def _history_start(self) -> int:
+        """Index of the first message after the starting system messages"""
+        start = 0
+        for msg in self.messages:
+            if msg["role"] != "system" or msg["content"].startswith(SUMMARY_PREFIX):
+                break
+            start += 1
+        return start
+
     def make_message(self, message: str, role: str = "user"):
         msg = {
             "role": role,
@@ -85,6 +208,8 @@ class OpenAIChatManager:
     def restart_conversation(self):
         """Restarts conversation"""
         self.messages = []
+        self._token_counts = {}
+        self.num_user_messages = 0
         self.num_images_generated = 0
         sys_msg = (
             self.start_system_message()
@@ -95,14 +220,13 @@ class OpenAIChatManager:
         self.add_message(sys_msg, role="system")
         # self.scheduler.pause()
         del managers[self.sender.phone_number]
+        path = chat_state_path(self.sender.phone_number)
+        if path is not None and path.exists():
+            path.unlink()
 
     def get_conversation(self):
-        msg_template = "{role}: {content}"
         return "\n".join(
-            [
-                msg_template.format(role=msg["role"].upper(), content=msg["content"])
-                for msg in self.messages
-            ]
+            f"{msg['role'].upper()}: {msg['content']}" for msg in self.messages
         )
 
     def __len__(self):
@@ -112,9 +236,21 @@ class OpenAIChatManager:
         return self.messages[index]
 
     def __delitem__(self, index):
+        deleted = self.messages[index]
+        if isinstance(deleted, dict):
+            deleted = [deleted]
+        self.num_user_messages -= sum(msg["role"] == "user" for msg in deleted)
         del self.messages[index]
 
 
+def chat_state_path(phone_number: str) -> Optional[Path]:
+    """Path of the file where the chat with the number is saved (None if disabled)"""
+    state_dir = os.environ.get("CHAT_STATE_DIR")
+    if not state_dir:
+        return None
+    return Path(state_dir) / (re.sub(r"[^\w+-]", "_", phone_number) + ".json")
+
+
 @dataclass
 class Sender:
     phone_number: str
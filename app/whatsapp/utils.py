@@ -13,6 +13,9 @@ from .chat import Sender, OpenAIChatManager
 
 logger = logging.getLogger("WP-APP")
 
+IMG_GENERATION_PATTERN = re.compile(r"\[img:\"(.*)\"\]", flags=re.IGNORECASE)
+CAPTIONING_PATTERN = re.compile(r"\[captioning:\s*(\w+)\]", flags=re.IGNORECASE)
+
 
 def verify_phone_number(phone_number: str) -> dict:
     """Make sure that the phone number is allowed to use the chatbot."""
@@ -21,7 +24,7 @@ def verify_phone_number(phone_number: str) -> dict:
         return True
     allowed_contacts = json.load(open(contacts_json, "r"))
     allowed_phone_numbers = [p["phone_number"] for p in allowed_contacts]
-    if phone_number not in [allowed_phone_numbers] + [
+    if phone_number not in allowed_phone_numbers + [
         "whatsapp:" + p for p in allowed_phone_numbers
     ]:
         return False
@@ -52,10 +55,8 @@ def ensure_image_generation(reply: str, chat: OpenAIChatManager, sender: Sender,
         )
         return "Sorry, you have reached the maximum number of images you can generate. Try again later."
     # get the prompt and real reply from the message '{reply}[image generation: "{prompt}"]'
-    img_generation_prompt = re.search(
-        r"\[img:\"(.*)\"\]", reply, flags=re.IGNORECASE
-    ).group(1)
-    reply = re.sub(r"\[img:\"(.*)\"\]", "", reply, flags=re.IGNORECASE)
+    img_generation_prompt = IMG_GENERATION_PATTERN.search(reply).group(1)
+    reply = IMG_GENERATION_PATTERN.sub("", reply)
     logger.info(f"Image generation prompt: '{img_generation_prompt}'")
     # send the image in a separate thread
     send_image_with_threading(img_generation_prompt, chat, sender, twilio_client)
@@ -75,7 +76,7 @@ def ensure_image_generation(reply: str, chat: OpenAIChatManager, sender: Sender,
 
 def ensure_captioning(msg, chat):
     """Check if the message contains a captioning command and set the chat's image captioning option accordingly"""
-    if (captioning:=re.search(r'\[captioning:\s*(\w+)\]',msg,re.IGNORECASE)):
+    if (captioning:=CAPTIONING_PATTERN.search(msg)):
         captioning = captioning.group(1)
         if captioning == 'on':
             chat.image_captioning = True
@@ -142,7 +143,7 @@ def save_to_contactbook(reqvals):
         }
         json.dump(contactbook, open(contactbook_path, "w"))
 
-def generate_image(prompt: str):
+def generate_image(prompt: str, size: str = "512x512"):
     """
     Generates a new image using the prompt given
     with the image generation API (OpenAI's DALL-E)
@@ -157,7 +158,7 @@ def generate_image(prompt: str):
     response = openai.Image.create(
         prompt=prompt,
         n=1,
-        size="1024x1024"
+        size=size
     )
     img = response["data"][0]
     img_url = img["url"]
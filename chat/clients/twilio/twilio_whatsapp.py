@@ -15,9 +15,11 @@ class Media:
     is_video: bool = field(init=False)
 
     def __post_init__(self):
-        self.__dict__['is_image'] = self.content_type.lower().startswith('image')
-        self.__dict__['is_video'] = self.content_type.lower().startswith('video')
-        self.__dict__['is_audio'] = self.content_type.lower().startswith('audio')
+        # the dataclass is frozen, so the derived fields are set through object
+        content_type = self.content_type.lower()
+        object.__setattr__(self, 'is_image', content_type.startswith('image'))
+        object.__setattr__(self, 'is_video', content_type.startswith('video'))
+        object.__setattr__(self, 'is_audio', content_type.startswith('audio'))
 
 @dataclass
 class TwilioWhatsAppMessage:
@@ -3,6 +3,8 @@
 import os, time, logging
 import requests
 
+from chat.handlers.http import session
+
 supported_language_codes = { # https://www.assemblyai.com/docs/#supported-languages
     'en': 'en',
     'english': 'en',
@@ -44,7 +46,7 @@ def transcribe_audio(media_url, *, chat=None, language_detection:bool=True, lang
         data['language_code'] = supported_language_codes.get(language_code, 'en')
         data['language_detection'] = False
     logger.info(f"Attempting to transcribe audio with {data=}")
-    response = requests.post(endpoint, json=data, headers=headers)
+    response = session.post(endpoint, json=data, headers=headers)
     response.raise_for_status()
     transcription_id = response.json()['id']
     try:
@@ -66,10 +68,10 @@ def transcribe_audio(media_url, *, chat=None, language_detection:bool=True, lang
 def _wait_for_transcription(transcription_id:str, headers:dict, timeout=30, logger=None):
     endpoint = f"https://api.assemblyai.com/v2/transcript/{transcription_id}"
     time_now = time.time()
-    response = requests.get(endpoint, headers=headers)
+    response = session.get(endpoint, headers=headers)
     while (status := response.json()['status']).lower() != 'completed':
         try:
-            response = requests.get(endpoint, headers=headers)
+            response = session.get(endpoint, headers=headers)
             response.raise_for_status()
         except requests.exceptions.HTTPError as e:
             raise e
@@ -0,0 +1,32 @@
+"""
+HTTP sessions shared by the handlers so that connections to the same hosts
+are kept alive and reused instead of opening a new one (and TLS handshake)
+for every request.
+"""
+from contextlib import asynccontextmanager
+
+import aiohttp
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+__all__ = ["session", "openai_aiosession"]
+
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50)
+session.mount("https://", _adapter)
+session.mount("http://", _adapter)
+
+@asynccontextmanager
+async def openai_aiosession(**kwargs):
+    """
+    Makes the asynchronous OpenAI requests awaited within the context
+    (including the tasks created in it) share a single aiohttp session.
+    Otherwise the openai library opens a new session for every request.
+    """
+    async with aiohttp.ClientSession(**kwargs) as aiosession:
+        token = openai.aiosession.set(aiosession)
+        try:
+            yield aiosession
+        finally:
+            openai.aiosession.reset(token)
@@ -1,12 +1,33 @@
-from .completions import text_completion, chat_completion, code_generation
+from .completions import (
+    text_completion,
+    atext_completion,
+    chat_completion,
+    achat_completion,
+    achat_completions,
+    stream_chat_completion,
+    astream_chat_completion,
+    summarize_messages,
+    asummarize_messages,
+    code_generation,
+)
 from .speech import voice_transcription, voice_translation
 from .images import text_to_image#, image_edit, image_variation
 from .edits import edit_text, edit_code
 from .moderation import text_moderation
+from .embeddings import text_embedding, atext_embedding
+from .cache import ResponseCache, SemanticCache
+from .tokens import num_tokens, num_message_tokens
 
 __all__ = [
     "text_completion",
+    "atext_completion",
     "chat_completion",
+    "achat_completion",
+    "achat_completions",
+    "stream_chat_completion",
+    "astream_chat_completion",
+    "summarize_messages",
+    "asummarize_messages",
     "code_generation",
     "voice_transcription",
     "voice_translation",
@@ -14,4 +35,10 @@ __all__ = [
     "edit_text",
     "edit_code",
     "text_moderation",
+    "text_embedding",
+    "atext_embedding",
+    "ResponseCache",
+    "SemanticCache",
+    "num_tokens",
+    "num_message_tokens",
 ]
\ No newline at end of file
@@ -0,0 +1,179 @@
+"""
+In-process caches for the responses of OpenAI's APIs
+"""
+import hashlib, json, threading
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+import numpy as np
+
+__all__ = [
+    "ResponseCache",
+    "SemanticCache",
+    "response_cache",
+    "is_deterministic",
+]
+
+# only replies generated with a temperature up to this value are cached
+MAX_CACHEABLE_TEMPERATURE = 0.05
+
+def is_deterministic(params: dict) -> bool:
+    """Whether the completion parameters produce (almost) deterministic replies"""
+    try:
+        temperature = float(params.get("temperature", 1))
+    except (TypeError, ValueError):
+        return False
+    return temperature <= MAX_CACHEABLE_TEMPERATURE
+
+
+class ResponseCache:
+    """
+    Least-recently-used cache of API replies keyed by the hash of the request.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of replies to keep, by default 1024
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+        # the cache is shared by the requests served in different threads
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, prompt: Any, params: dict) -> str:
+        """Returns the hash identifying a request"""
+        payload = json.dumps(
+            {"model": model, "prompt": prompt, "params": params},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key not in self._entries:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.stats = {"hits": 0, "misses": 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: str):
+        return key in self._entries
+
+
+class SemanticCache:
+    """
+    Cache of chat replies looked up by the similarity of the user's message.
+
+    A cached reply is only reused when the embedding of the new user message is
+    close enough to the one of a previous message *and* the messages preceding it
+    in the conversation are the same, so that contextual follow-ups
+    (e.g. "now make it red") aren't answered with an unrelated reply.
+    The context includes every system message (user details, language, summaries),
+    so replies are never shared between conversations with different ones.
+
+    Parameters
+    ----------
+    threshold : float, optional
+        The minimum cosine similarity to consider two messages equivalent,
+        by default 0.92
+    context_size : int, optional
+        The number of previous user/assistant messages that must match,
+        by default 2
+    maxsize : int, optional
+        The maximum number of replies to keep, by default 1024
+    """
+
+    def __init__(self, threshold: float = 0.92, context_size: int = 2, maxsize: int = 1024):
+        self.threshold = threshold
+        self.context_size = context_size
+        self.maxsize = maxsize
+        self._embeddings = np.empty((0, 0), dtype=np.float32)
+        self._contexts = []
+        self._replies = []
+        self.stats = {"hits": 0, "misses": 0}
+        # the cache is shared by the requests served in different threads
+        self._lock = threading.Lock()
+
+    def context_key(self, messages: List[dict]) -> str:
+        """
+        Returns the hash of the context of the last message: all the system messages
+        and the last `context_size` other messages that precede it.
+        """
+        system = [msg for msg in messages[:-1] if msg["role"] == "system"]
+        context = [msg for msg in messages[:-1] if msg["role"] != "system"]
+        context = context[-self.context_size:] if self.context_size > 0 else []
+        payload = json.dumps(
+            [(msg["role"], msg["content"]) for msg in system + context], default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, messages: List[dict], embedding: List[float]) -> Optional[str]:
+        """Returns the cached reply for the last message or None if there isn't one"""
+        vector = self._normalize(embedding)
+        context = self.context_key(messages)
+        with self._lock:
+            if len(self._replies) > 0:
+                similarities = self._embeddings @ vector
+                for idx in np.argsort(-similarities):
+                    if similarities[idx] < self.threshold:
+                        break
+                    if self._contexts[idx] == context:
+                        self.stats["hits"] += 1
+                        return self._replies[idx]
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, messages: List[dict], embedding: List[float], reply: str):
+        vector = self._normalize(embedding)[np.newaxis, :]
+        context = self.context_key(messages)
+        with self._lock:
+            if len(self._replies) == 0:
+                self._embeddings = vector
+            else:
+                self._embeddings = np.vstack([self._embeddings, vector])
+            self._contexts.append(context)
+            self._replies.append(reply)
+            if len(self._replies) > self.maxsize:
+                self._embeddings = self._embeddings[1:]
+                self._contexts.pop(0)
+                self._replies.pop(0)
+
+    def clear(self):
+        with self._lock:
+            self._embeddings = np.empty((0, 0), dtype=np.float32)
+            self._contexts = []
+            self._replies = []
+            self.stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def __len__(self):
+        return len(self._replies)
+
+
+response_cache = ResponseCache()
@@ -1,20 +1,51 @@
 """
 Handlers for OpenAI's Completion and Chat Completion APIs
 """
-import logging, re
-from typing import List
+import asyncio, logging, re
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterator, List
 
 import openai
 from chat.clients import ChatClient
+from chat.handlers.http import openai_aiosession
+from .cache import ResponseCache, SemanticCache, response_cache, is_deterministic
+from .embeddings import text_embedding, atext_embedding
+from .ratelimit import RateLimiter, rate_limiter as default_rate_limiter, with_retries
+from .tokens import estimate_message_tokens
 
 __all__ = [
     "text_completion",
+    "atext_completion",
     "chat_completion",
+    "achat_completion",
+    "achat_completions",
+    "stream_chat_completion",
+    "astream_chat_completion",
+    "summarize_messages",
+    "asummarize_messages",
     "code_generation",
     "whisper_voice_transcription",
     "dalle_text_to_image",
 ]
 
+# the "-> ..." suffix that models sometimes echo from the few-shot examples
+_ARROW_SUFFIX = re.compile(r" ->.*")
+
+CHAT_MODEL_PREFIXES = ("gpt-3.5-turbo", "gpt-4")
+
+def is_chat_model(model: str) -> bool:
+    """Whether the model must be queried through the Chat Completion API"""
+    return model.startswith(CHAT_MODEL_PREFIXES)
+
+def as_chat_messages(prompt) -> List[dict]:
+    """
+    Returns the prompt as a list of chat messages.
+    A plain string prompt is sent as a single user message.
+    """
+    if isinstance(prompt, str):
+        return [{'role': 'user', 'content': prompt}]
+    return prompt
+
 def text_completion(
     prompt: str,
     chat: ChatClient = None,
@@ -40,8 +71,9 @@ def text_completion(
     if "model" in kwargs:
         engine = kwargs.pop("model")
     logging.info(f"Querying OpenAI's Completion API with prompt '{prompt}'")
-    if engine == 'gpt-3.5-turbo':
-        return chat_completion(prompt, model=engine, **kwargs)
+    if is_chat_model(engine):
+        # keep the messages structured so that the conversation prefix can be cached
+        return chat_completion(as_chat_messages(prompt), model=engine, **kwargs)
     elif isinstance(prompt, list):
         prompt = "\n".join(f"{d['role'].upper()}: {d['content']}" for d in prompt)
     response = openai.Completion.create(
@@ -54,6 +86,8 @@ def text_completion(
 def chat_completion(
     messages: List[dict],
     model: str = "gpt-3.5-turbo",
+    cache: ResponseCache = response_cache,
+    semantic_cache: SemanticCache = None,
     **kwargs
 ):
     """
@@ -67,6 +101,12 @@ def chat_completion(
         The chat client, by default None
     model : str, optional
         The model to use, by default "gpt-3.5-turbo"
+    cache : ResponseCache, optional
+        The cache where replies to deterministic requests (temperature close to 0)
+        are stored and reused. Set to None to always query the API.
+    semantic_cache : SemanticCache, optional
+        A cache where the reply to the last user message is looked up by similarity
+        with previous messages with the same context, by default None
     **kwargs
         Additional keyword arguments to pass to the Chat Completion API.
         See https://platform.openai.com/docs/api-reference/chat/create for a list of
@@ -74,20 +114,293 @@ def chat_completion(
     """
     if "engine" in kwargs:
         model = kwargs.pop("engine")
+    cache_key = _cache_key(cache, model, messages, kwargs)
+    if cache_key is not None and (reply := cache.get(cache_key)) is not None:
+        return reply
+    embedding = None
+    if _semantically_cacheable(semantic_cache, messages):
+        embedding = text_embedding(messages[-1]["content"])
+        if (reply := semantic_cache.get(messages, embedding)) is not None:
+            return reply
     response = openai.ChatCompletion.create(
         model=model,
         messages=messages,
         **kwargs
     )
+    reply = response.get("choices",[{}])[0].get("message", {}).get("content")
+    if reply is not None:
+        if cache_key is not None:
+            cache.set(cache_key, reply)
+        if embedding is not None:
+            semantic_cache.set(messages, embedding, reply)
+    return reply
+
+def _cache_key(cache: ResponseCache, model: str, messages: List[dict], params: dict):
+    """Returns the cache key of the request or None if it shouldn't be cached"""
+    if cache is None or not is_deterministic(params) or params.get("stream"):
+        return None
+    return cache.make_key(model, messages, params)
+
+def _request_tokens(messages: List[dict], num_prompt_tokens: int, params: dict) -> int:
+    """Tokens of a request, as counted by the rate limiter"""
+    if num_prompt_tokens is None:
+        num_prompt_tokens = estimate_message_tokens(messages)
+    return num_prompt_tokens + int(params.get("max_tokens") or 0)
+
+@asynccontextmanager
+async def _limited(rate_limiter: RateLimiter, num_tokens: int):
+    """Waits for the rate limiter, if any"""
+    if rate_limiter is None:
+        yield
+        return
+    async with rate_limiter.limit(num_tokens):
+        yield
+
+def _semantically_cacheable(semantic_cache: SemanticCache, messages: List[dict]) -> bool:
+    """Whether the reply to the last message can be looked up in the semantic cache"""
+    return (
+        semantic_cache is not None
+        and len(messages) > 0
+        and messages[-1].get("role") == "user"
+        and bool(messages[-1].get("content"))
+    )
+
+def stream_chat_completion(
+    messages: List[dict],
+    model: str = "gpt-3.5-turbo",
+    cache: ResponseCache = response_cache,
+    **kwargs
+) -> Iterator[str]:
+    """
+    Streams the chat completion from OpenAI's Chat Completion API.
+    Yields the pieces of the reply as soon as they are generated, so the caller
+    can start processing the reply before it is fully completed.
+    Deterministic replies are shared with `chat_completion` through the `cache`,
+    a cached reply is yielded at once.
+
+    The WhatsApp app doesn't use it (Twilio only sends whole messages), it is meant
+    for library users.
+
+    Parameters
+    ----------
+    messages : List[dict]
+        A list of messages to complete.
+    model : str, optional
+        The model to use, by default "gpt-3.5-turbo"
+    cache : ResponseCache, optional
+        The cache of replies to deterministic requests, by default the shared one.
+        Set to None to always query the API.
+    **kwargs
+        Additional keyword arguments to pass to the Chat Completion API.
+
+    Usage
+    -----
+    >>> reply = "".join(stream_chat_completion(messages))
+    """
+    if "engine" in kwargs:
+        model = kwargs.pop("engine")
+    kwargs.pop("stream", None)
+    cache_key = _cache_key(cache, model, messages, kwargs)
+    if cache_key is not None and (reply := cache.get(cache_key)) is not None:
+        yield reply
+        return
+    response = openai.ChatCompletion.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        **kwargs
+    )
+    pieces = []
+    for chunk in response:
+        content = chunk.get("choices",[{}])[0].get("delta", {}).get("content")
+        if content:
+            pieces.append(content)
+            yield content
+    if cache_key is not None:
+        cache.set(cache_key, "".join(pieces))
+
+async def astream_chat_completion(
+    messages: List[dict],
+    model: str = "gpt-3.5-turbo",
+    cache: ResponseCache = response_cache,
+    rate_limiter: RateLimiter = default_rate_limiter,
+    num_prompt_tokens: int = None,
+    **kwargs
+) -> AsyncIterator[str]:
+    """
+    Asynchronous version of `stream_chat_completion`.
+    Like `achat_completion`, it waits for the `rate_limiter` (which counts the
+    request as concurrent until the stream ends) and retries the request on
+    rate limit and transient errors, as long as nothing was streamed yet.
+    """
+    if "engine" in kwargs:
+        model = kwargs.pop("engine")
+    kwargs.pop("stream", None)
+    cache_key = _cache_key(cache, model, messages, kwargs)
+    if cache_key is not None and (reply := cache.get(cache_key)) is not None:
+        yield reply
+        return
+    async def create():
+        return await openai.ChatCompletion.acreate(
+            model=model,
+            messages=messages,
+            stream=True,
+            **kwargs
+        )
+    pieces = []
+    num_tokens = _request_tokens(messages, num_prompt_tokens, kwargs)
+    async with _limited(rate_limiter, num_tokens):
+        response = await with_retries(create)
+        async for chunk in response:
+            content = chunk.get("choices",[{}])[0].get("delta", {}).get("content")
+            if content:
+                pieces.append(content)
+                yield content
+    if cache_key is not None:
+        cache.set(cache_key, "".join(pieces))
+
+async def atext_completion(
+    prompt: str,
+    chat: ChatClient = None,
+    engine: str = "text-davinci-003",
+    **kwargs
+):
+    """
+    Asynchronous version of `text_completion`.
+    The request is awaited so other conversations can be served meanwhile.
+    """
+    if "model" in kwargs:
+        engine = kwargs.pop("model")
+    logging.info(f"Querying OpenAI's Completion API with prompt '{prompt}'")
+    if is_chat_model(engine):
+        return await achat_completion(as_chat_messages(prompt), model=engine, **kwargs)
+    elif isinstance(prompt, list):
+        prompt = "\n".join(f"{d['role'].upper()}: {d['content']}" for d in prompt)
+    response = await openai.Completion.acreate(
+        prompt=prompt,
+        engine=engine,
+        **kwargs
+    )
+    return response.get("choices",[{}])[0].get("text")
 
-    return response.get("choices",[{}])[0].get("message", {}).get("content")
+async def achat_completion(
+    messages: List[dict],
+    model: str = "gpt-3.5-turbo",
+    cache: ResponseCache = response_cache,
+    semantic_cache: SemanticCache = None,
+    rate_limiter: RateLimiter = default_rate_limiter,
+    num_prompt_tokens: int = None,
+    **kwargs
+):
+    """
+    Asynchronous version of `chat_completion`.
+    The request is awaited so other conversations can be served meanwhile.
+    Requests wait for the `rate_limiter` (set to None to disable it) and are
+    retried with exponential backoff on rate limit and transient errors.
+    The tokens of the request are counted as `num_prompt_tokens` (if known by the
+    caller, otherwise estimated from the length of the messages) plus `max_tokens`.
+    """
+    if "engine" in kwargs:
+        model = kwargs.pop("engine")
+    cache_key = _cache_key(cache, model, messages, kwargs)
+    if cache_key is not None and (reply := cache.get(cache_key)) is not None:
+        return reply
+    embedding = None
+    if _semantically_cacheable(semantic_cache, messages):
+        embedding = await atext_embedding(messages[-1]["content"])
+        if (reply := semantic_cache.get(messages, embedding)) is not None:
+            return reply
+    async def create():
+        num_tokens = _request_tokens(messages, num_prompt_tokens, kwargs)
+        async with _limited(rate_limiter, num_tokens):
+            return await openai.ChatCompletion.acreate(model=model, messages=messages, **kwargs)
+
+    response = await with_retries(create)
+    reply = response.get("choices",[{}])[0].get("message", {}).get("content")
+    if reply is not None:
+        if cache_key is not None:
+            cache.set(cache_key, reply)
+        if embedding is not None:
+            semantic_cache.set(messages, embedding, reply)
+    return reply
+
+async def achat_completions(
+    conversations: List[List[dict]],
+    model: str = "gpt-3.5-turbo",
+    **kwargs
+) -> List[str]:
+    """
+    Generates the chat completions of several conversations concurrently.
+
+    Parameters
+    ----------
+    conversations : List[List[dict]]
+        A list with the messages of each conversation to complete.
+    model : str, optional
+        The model to use, by default "gpt-3.5-turbo"
+    **kwargs
+        Additional keyword arguments to pass to the Chat Completion API.
+
+    Returns
+    -------
+    List[str]
+        The replies in the same order as the given conversations.
+    """
+    async with openai_aiosession():
+        return await asyncio.gather(
+            *(achat_completion(messages, model=model, **kwargs) for messages in conversations)
+        )
+
+SUMMARY_PROMPT = (
+    "Summarize the following conversation between a user and an AI assistant "
+    "in a few sentences. Keep the facts needed to carry on with the conversation."
+)
+
+def _summary_messages(messages: List[dict]) -> List[dict]:
+    transcript = "\n".join(f"{msg['role'].upper()}: {msg['content']}" for msg in messages)
+    return [
+        {'role': 'system', 'content': SUMMARY_PROMPT},
+        {'role': 'user', 'content': transcript},
+    ]
+
+def summarize_messages(
+    messages: List[dict],
+    model: str = "gpt-3.5-turbo",
+    **kwargs
+) -> str:
+    """
+    Summarizes a list of chat messages using OpenAI's Chat Completion API.
+    Used to replace the oldest messages of long conversations.
+
+    Parameters
+    ----------
+    messages : List[dict]
+        The messages to summarize.
+    model : str, optional
+        The model to use, by default "gpt-3.5-turbo"
+    **kwargs
+        Additional keyword arguments to pass to the Chat Completion API.
+    """
+    kwargs.setdefault("temperature", 0)
+    return chat_completion(_summary_messages(messages), model=model, **kwargs)
+
+async def asummarize_messages(
+    messages: List[dict],
+    model: str = "gpt-3.5-turbo",
+    **kwargs
+) -> str:
+    """
+    Asynchronous version of `summarize_messages`.
+    """
+    kwargs.setdefault("temperature", 0)
+    return await achat_completion(_summary_messages(messages), model=model, **kwargs)
 
 
 def text_translation(
     text: str,
     to: str = "english",
     from_: str = None,
-    engine: str = "text-da-vinci-003",
+    engine: str = "text-davinci-003",
     prompt: str = None,
     examples: List[str] = None,
     **kwargs
@@ -139,7 +452,7 @@ def text_translation(
             [f"{txt} -> {translation}" for txt, translation in examples]
         )
     prompt += f"\n----\n{text} ->"
-    if engine == 'gpt-3.5-turbo':
+    if is_chat_model(engine):
         messages = [
             {'role': 'user', 'content': prompt},
         ]
@@ -149,7 +462,7 @@ def text_translation(
         # print(f"Querying OpenAI's Completion API with prompt '{prompt}'")
         kwargs['stop'] = '\n'
         result_text = text_completion(prompt, engine=engine, **kwargs)
-    return re.sub(r" ->.*", "", result_text).strip()
+    return _ARROW_SUFFIX.sub("", result_text).strip()
 
 async def atext_translation(*args, **kwargs):
     return text_translation(*args, **kwargs)
@@ -194,7 +507,7 @@ def language_detection(
         [f"\"{txt}\" -> {language}" for txt, language in examples]
     )
     prompt += f"\n---\n{text} ->"
-    if engine == 'gpt-3.5-turbo':
+    if is_chat_model(engine):
         messages = [
             {'role': 'system', 'content': prompt},
         ]
@@ -205,7 +518,7 @@ def language_detection(
         # print(f"Querying OpenAI's Completion API with prompt '{prompt}'")
         kwargs['stop'] = '\n'
         result_text = text_completion(prompt, engine=engine, **kwargs)
-    detected_lang = re.sub(r" ->.*", "", result_text).strip().lower()
+    detected_lang = _ARROW_SUFFIX.sub("", result_text).strip().lower()
     if len(detected_lang.split()) > 1:
         detected_lang = detected_lang.split()[0]
     return detected_lang
@@ -0,0 +1,58 @@
+"""
+Handlers for OpenAI's Embeddings API
+"""
+import logging
+from typing import List
+
+import openai
+
+from .ratelimit import RateLimiter, rate_limiter as default_rate_limiter, with_retries
+from .tokens import CHARS_PER_TOKEN
+
+__all__ = [
+    "text_embedding",
+    "atext_embedding",
+]
+
+def text_embedding(
+    text: str,
+    model: str = "text-embedding-ada-002",
+    **kwargs
+) -> List[float]:
+    """
+    Returns the embedding of the text using OpenAI's Embeddings API.
+
+    Parameters
+    ----------
+    text : str
+        The text to embed.
+    model : str, optional
+        The model to use, by default "text-embedding-ada-002"
+    **kwargs
+        Additional keyword arguments to pass to the Embeddings API.
+        See https://platform.openai.com/docs/api-reference/embeddings for a list of
+        valid parameters.
+    """
+    logging.debug(f"Querying OpenAI's Embeddings API with text '{text}'")
+    response = openai.Embedding.create(input=text, model=model, **kwargs)
+    return response.get("data",[{}])[0].get("embedding")
+
+async def atext_embedding(
+    text: str,
+    model: str = "text-embedding-ada-002",
+    rate_limiter: RateLimiter = default_rate_limiter,
+    **kwargs
+) -> List[float]:
+    """
+    Asynchronous version of `text_embedding`.
+    Like the chat completions, requests wait for the `rate_limiter` (set to None
+    to disable it) and are retried on rate limit and transient errors.
+    """
+    logging.debug(f"Querying OpenAI's Embeddings API with text '{text}'")
+    async def create():
+        if rate_limiter is None:
+            return await openai.Embedding.acreate(input=text, model=model, **kwargs)
+        async with rate_limiter.limit(len(text) // CHARS_PER_TOKEN + 1):
+            return await openai.Embedding.acreate(input=text, model=model, **kwargs)
+    response = await with_retries(create)
+    return response.get("data",[{}])[0].get("embedding")
@@ -1,16 +1,19 @@
 import os, logging
 from chat.clients import ChatClient
-import openai, requests
+from chat.handlers.http import session
+import openai
 
-async def text_to_image(prompt: str, *, as_url=True, **kwargs):
-    """Generate an image asychronously given the prompt"""
+async def text_to_image(prompt: str, *, as_url=True, size: str = "512x512", **kwargs):
+    """
+    Generate an image asychronously given the prompt.
+    Smaller sizes ("256x256", "512x512") are faster to generate and send than "1024x1024".
+    """
     logging.debug(
         f"Querying OpenAI's Image API 'DALL-E' with prompt '{prompt}'"
     )
-    creation_params = dict(n=1, size="1024x1024")
+    creation_params = dict(n=1, size=size)
     creation_params.update(kwargs)
-    # create a partial function to send the image with the given parameters
-    response = openai.Image.create(
+    response = await openai.Image.acreate(
         prompt=prompt,
         **creation_params)
     data = response.get("data")
@@ -22,4 +25,4 @@ async def text_to_image(prompt: str, *, as_url=True, **kwargs):
     if as_url:
         return image_url
     else:
-        return requests.get(image_url).content
\ No newline at end of file
+        return session.get(image_url).content
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""
+Client-side rate limiting and retries for the asynchronous requests to OpenAI's API
+"""
+import asyncio, logging, os, random, threading, time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, TypeVar
+
+import openai
+
+__all__ = [
+    "TokenBucket",
+    "RateLimiter",
+    "rate_limiter",
+    "with_retries",
+]
+
+T = TypeVar("T")
+
+# errors after which the same request can be sent again
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+
+class TokenBucket:
+    """
+    Leaky bucket that allows up to `rate_per_minute` units per minute,
+    refilled continuously.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = rate_per_minute
+        self._available = rate_per_minute
+        self._updated_at = time.monotonic()
+        # the bucket can be shared by the event loops of different threads
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, amount: float) -> float:
+        """Takes the amount if available, otherwise returns the seconds to wait for it"""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._updated_at
+            self._available = min(self.capacity, self._available + elapsed * self.capacity / 60)
+            self._updated_at = now
+            amount = min(amount, self.capacity)
+            if self._available >= amount:
+                self._available -= amount
+                return 0
+            return (amount - self._available) * 60 / self.capacity
+
+    async def acquire(self, amount: float = 1):
+        """Waits until the amount is available in the bucket and takes it"""
+        while (wait_seconds := self._try_acquire(amount)) > 0:
+            await asyncio.sleep(wait_seconds)
+
+
+class RateLimiter:
+    """
+    Limits the concurrent requests and the requests and tokens sent per minute.
+
+    Parameters
+    ----------
+    max_requests_per_minute : int, optional
+        By default 3500
+    max_tokens_per_minute : int, optional
+        By default 90000
+    max_concurrent_requests : int, optional
+        By default 250
+    """
+
+    def __init__(
+        self,
+        max_requests_per_minute: int = 3500,
+        max_tokens_per_minute: int = 90000,
+        max_concurrent_requests: int = 250,
+    ):
+        self.requests = TokenBucket(max_requests_per_minute)
+        self.tokens = TokenBucket(max_tokens_per_minute)
+        self.max_concurrent_requests = max_concurrent_requests
+        # Flask runs every async view in its own event loop (and thread), so the cap
+        # is a thread semaphore polled without blocking the loop rather than an
+        # asyncio.Semaphore, which would be bound to a single loop
+        self._concurrent_requests = threading.BoundedSemaphore(max_concurrent_requests)
+
+    async def _acquire_request_slot(self):
+        while not self._concurrent_requests.acquire(blocking=False):
+            await asyncio.sleep(0.05)
+
+    @asynccontextmanager
+    async def limit(self, num_tokens: int = 0):
+        """
+        Waits until a request with `num_tokens` tokens can be sent.
+        The limits are shared by all the event loops and threads of the process.
+        """
+        await self._acquire_request_slot()
+        try:
+            await self.requests.acquire(1)
+            if num_tokens > 0:
+                await self.tokens.acquire(num_tokens)
+            yield
+        finally:
+            self._concurrent_requests.release()
+
+
+async def with_retries(
+    request: Callable[[], Awaitable[T]],
+    max_attempts: int = 5,
+    max_wait_seconds: float = 60,
+) -> T:
+    """
+    Awaits the request, retrying it with an exponential backoff (with jitter)
+    when OpenAI's API fails with a rate limit or a transient error.
+    """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return await request()
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_attempts:
+                raise
+            wait_seconds = min(max_wait_seconds, 2 ** attempt + random.uniform(0, 1))
+            logging.warning(
+                f"OpenAI request failed ({e.__class__.__name__}: {e}), "
+                f"retrying in {wait_seconds:.1f} seconds ({attempt}/{max_attempts})"
+            )
+            await asyncio.sleep(wait_seconds)
+
+
+rate_limiter = RateLimiter(
+    max_requests_per_minute=int(os.environ.get("OPENAI_MAX_REQUESTS_PER_MINUTE", 3500)),
+    max_tokens_per_minute=int(os.environ.get("OPENAI_MAX_TOKENS_PER_MINUTE", 90000)),
+    max_concurrent_requests=int(os.environ.get("OPENAI_MAX_CONCURRENT_REQUESTS", 250)),
+)
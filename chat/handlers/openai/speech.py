@@ -2,9 +2,9 @@ import tempfile
 from typing import List, Union
 
 import openai
-import requests
 
 from chat.clients import ChatClient
+from chat.handlers.http import session
 
 def voice_transcription(
     url_or_file: str,
@@ -29,7 +29,7 @@ def voice_transcription(
     **kwargs
     """
     if url_or_file.startswith("http"):
-        response = requests.get(url_or_file)
+        response = session.get(url_or_file)
         response.raise_for_status()
         audio = response.content
         # create the file
@@ -68,7 +68,7 @@ def voice_translation(
     **kwargs
     """
     if url_or_file.startswith("http"):
-        response = requests.get(url_or_file)
+        response = session.get(url_or_file)
         response.raise_for_status()
         audio = response.content
         # create the file
@@ -0,0 +1,66 @@
+"""
+Token counting for OpenAI's models
+"""
+import logging
+from functools import lru_cache
+from typing import List, Optional
+
+import tiktoken
+
+__all__ = [
+    "num_tokens",
+    "num_message_tokens",
+    "estimate_message_tokens",
+]
+
+# tokens added by the chat format around the content of each message
+TOKENS_PER_MESSAGE = 4
+# tokens that prime the reply of the assistant
+TOKENS_PER_REPLY = 2
+
+# approximate number of characters per token, used when the tokenizer is unavailable
+CHARS_PER_TOKEN = 4
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> Optional[tiktoken.Encoding]:
+    """
+    Returns the tokenizer of the model (cl100k_base if the model is unknown).
+    tiktoken downloads the encoding the first time it is used; if that fails,
+    None is returned and the token counts are estimated from the text length.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logging.warning(f"Could not load the tokenizer of {model}, estimating token counts: {e}")
+        return None
+
+def num_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """Returns the number of tokens of the text for the given model"""
+    if not text:
+        return 0
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text))
+
+def num_message_tokens(messages: List[dict], model: str = "gpt-3.5-turbo") -> int:
+    """
+    Returns the (approximate) number of prompt tokens that the messages
+    take when sent to the Chat Completion API.
+    """
+    return TOKENS_PER_REPLY + sum(
+        TOKENS_PER_MESSAGE + num_tokens(msg["content"], model) for msg in messages
+    )
+
+def estimate_message_tokens(messages: List[dict]) -> int:
+    """
+    Cheap estimate of the prompt tokens of the messages from their length,
+    for when tokenizing the whole conversation isn't worth it (e.g. rate limiting).
+    """
+    return TOKENS_PER_REPLY + sum(
+        TOKENS_PER_MESSAGE + len(msg["content"] or "") // CHARS_PER_TOKEN
+        for msg in messages
+    )